@@ -61,45 +61,92 @@ DESCRIPTION:
 #   Find start commit
 #   Process in reverse order
 
-from __future__ import print_function, division
-from os import error
-
 import sys
+import io
 import re
 import subprocess
 import stat
-import pprint
 from string import Template
 import argparse
+import ast
+import operator
 import textwrap
 import os.path
 from datetime import datetime
 import logging
 import time
 import platform
+import signal
 import collections
+import functools
+import concurrent.futures
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
 
 # Non-standard modules
 import P4
 import logutils
 
-# Import yaml which will roundtrip comments
+# Optional - in process access to git objects (see use_pygit2 config option).
+# Only imported if that option is enabled as the import itself is relatively slow.
+pygit2 = None
+
+
+def importPygit2():
+    "Returns the pygit2 module, or None if not installed"
+    global pygit2
+    if pygit2 is None:
+        try:
+            import pygit2
+        except ImportError:
+            return None
+    return pygit2
+
 from ruamel.yaml import YAML
-yaml = YAML()
-subproc = subprocess  # Could have a wrapper for use on Windows
+# Config is only ever read, so the safe loader (plain dicts, uses the C loader if ruamel.yaml.clib is installed) is sufficient.
+# Note PyYAML is not used as its YAML 1.1 rules would turn y/n option values into booleans.
+yaml = YAML(typ='safe')
 
-VERSION = """$Id: 74939df934a7a660e6beff62870f65635918300b $"""
-ANON_BRANCH_PREFIX = "_anon"
 
+class SubProcess:
+    """Wrapper for subprocess calls (could also handle Windows specifics).
+    Pipes default to being fully buffered (bufsize=-1) - reading large git output
+    through an unbuffered pipe costs a read() syscall for every few bytes.
+    On Linux the stdout pipe is also enlarged so git can keep producing output while we parse."""
+
+    pipeSize = 1 << 20
+
+    @staticmethod
+    def Popen(*args, **kwargs):
+        kwargs.setdefault('bufsize', -1)
+        p = subprocess.Popen(*args, **kwargs)
+        if p.stdout is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                fcntl.fcntl(p.stdout.fileno(), fcntl.F_SETPIPE_SZ, SubProcess.pipeSize)
+            except OSError:
+                pass    # Larger than /proc/sys/fs/pipe-max-size - keep default
+        return p
 
-if bytes is not str:
-    # For python3, always encode and decode as appropriate
-    def decode_text_stream(s):
-        return s.decode() if isinstance(s, bytes) else s
-else:
-    # For python2.7, pass read strings as-is
-    def decode_text_stream(s):
-        return s
+    @staticmethod
+    def PopenText(*args, **kwargs):
+        """As Popen but pipes are utf-8 text - any bytes which are not valid utf-8 are preserved as surrogates.
+        Unlike Popen(text=True) lines are only split on \\n and a \\r is left alone (e.g. in commit messages)"""
+        p = SubProcess.Popen(*args, **kwargs)
+        if p.stdout is not None:
+            p.stdout = io.TextIOWrapper(p.stdout, encoding='utf-8', errors='surrogateescape', newline='\n')
+        if p.stdin is not None:
+            p.stdin = io.TextIOWrapper(p.stdin, encoding='utf-8', errors='surrogateescape', newline='\n',
+                                       write_through=True)
+        return p
+
+
+subproc = SubProcess
+
+VERSION = """$Id: 74939df934a7a660e6beff62870f65635918300b $"""
+ANON_BRANCH_PREFIX = "_anon"
+TREE_MODE = "040000"
 
 
 def anonymousBranch(branch):
@@ -107,19 +154,35 @@ def anonymousBranch(branch):
 
 
 def logrepr(self):
-    return pprint.pformat(self.__dict__, width=240)
+    "Full dump is only worth its cost if debug output is going to be written - plain dict repr avoids pprint's pure Python walk"
+    if logging.getLogger(LOGGER_NAME).isEnabledFor(logging.DEBUG):
+        return repr(self.__dict__)
+    return "<%s %s>" % (type(self).__name__, getattr(self, 'depotFile', ''))
 
 
-alreadyLogged = {}
+# Keys of messages logged - bounded (least recently seen dropped first) so long running transfers don't grow it forever
+alreadyLogged = collections.OrderedDict()
+alreadyLoggedMax = 4096
+_logOnceKeyTypes = (str, int, float, bool, type(None))
 
 
 # Log messages just once per run
 def logOnce(logger, *args):
-    global alreadyLogged
-    msg = ", ".join([str(x) for x in args])
-    if msg not in alreadyLogged:
-        alreadyLogged[msg] = 1
-        logger.debug(msg)
+    # Simple values are their own key, so messages already logged are skipped without any formatting.
+    # Other objects (e.g. options) are keyed on their repr so that changed contents are logged again.
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if all(isinstance(x, _logOnceKeyTypes) for x in args):
+        key = args
+    else:
+        key = tuple(repr(x) for x in args)
+    if key in alreadyLogged:
+        alreadyLogged.move_to_end(key)
+    else:
+        alreadyLogged[key] = None
+        if len(alreadyLogged) > alreadyLoggedMax:
+            alreadyLogged.popitem(last=False)
+        logger.debug(", ".join([str(x) for x in args]))
 
 
 #
@@ -127,12 +190,15 @@ def logOnce(logger, *args):
 # if you simply add them, but you can force it with "-f", in
 # which case it translates them into %xx encoding internally.
 #
+# Cannot have * in a filename in windows; untested as to
+# what p4 would do in such a case.
+_decodeWildcardStar = platform.system() != "Windows"
+
+
 def wildcard_decode(path):
     # Search for and fix just these four characters.  Do % last so
     # that fixing it does not inadvertently create new %-escapes.
-    # Cannot have * in a filename in windows; untested as to
-    # what p4 would do in such a case.
-    if not platform.system() == "Windows":
+    if _decodeWildcardStar:
         path = path.replace("%2A", "*")
     path = path.replace("%23", "#") \
                .replace("%40", "@") \
@@ -149,29 +215,46 @@ def wildcard_encode(path):
     return path
 
 
+_wildcard_chars = frozenset("*#@%")
+
+
 def wildcard_present(path):
-    m = re.search("[*#@%]", path)
-    return m is not None
+    return not _wildcard_chars.isdisjoint(path)
+
+
+_execModes = frozenset(("100755", "755"))
 
 
 def isModeExec(mode):
     # Returns True if the given git mode represents an executable file,
-    # otherwise False.
-    return mode[-3:] == "755"
+    # otherwise False. Git always reports the full 6 digit mode.
+    return mode in _execModes
 
 
 def isModeExecChanged(src_mode, dst_mode):
     return isModeExec(src_mode) != isModeExec(dst_mode)
 
 
-_diff_tree_pattern = None
+_diff_tree_pattern = re.compile(r'^:(\d+) (\d+) ([0-9a-f]+) ([0-9a-f]+) ([A-Z])(\d+)?\t([^\t\n]*)(?:\t(.*))?$')
+
+# Git only ever reports a handful of distinct modes - share one string object for each
+_gitModes = {m: sys.intern(m) for m in ('000000', '100644', '100755', '120000', '160000', TREE_MODE)}
+
+
+def internMode(mode):
+    return _gitModes.get(mode, mode)
+
 
+# Immutable (so that cached results can be safely shared between callers)
+DiffEntry = collections.namedtuple('DiffEntry', 'src_mode dst_mode src_sha1 dst_sha1 status status_score src dst')
 
+
+@functools.lru_cache(maxsize=1 << 16)
 def parseDiffTreeEntry(entry):
     """Parses a single diff tree entry into its component elements.
 
     See git-diff-tree(1) manpage for details about the format of the diff
-    output. This method returns a dictionary with the following elements:
+    output. This method returns a DiffEntry with the following elements:
 
     src_mode - The mode of the source file
     dst_mode - The mode of the destination file
@@ -184,24 +267,24 @@ def parseDiffTreeEntry(entry):
     dst - The path for the destination file. This is only present for
           copy or renames. If it is not present, this is None.
 
-    If the pattern is not matched, None is returned."""
+    If the pattern is not matched, None is returned.
+    Results are cached as identical lines recur (e.g. across merge commits)."""
 
-    global _diff_tree_pattern
-    if not _diff_tree_pattern:
-        _diff_tree_pattern = re.compile(':(\d+) (\d+) (\w+) (\w+) ([A-Z])(\d+)?\t(.*?)((\t(.*))|$)')
+    # Fast path - the raw format is fixed so plain splits avoid the regex engine
+    if entry.startswith(':'):
+        meta, _, paths = entry.rstrip('\n').partition('\t')
+        parts = meta[1:].split(' ')
+        status = parts[-1]
+        if paths and len(parts) == 5 and 'A' <= status[:1] <= 'Z' and (len(status) == 1 or status[1:].isdigit()):
+            paths = paths.split('\t', 1)
+            return DiffEntry(internMode(parts[0]), internMode(parts[1]), parts[2], parts[3], status[0], status[1:] or None,
+                             PathQuoting.dequote(paths[0]),
+                             PathQuoting.dequote(paths[1]) if len(paths) > 1 else None)
 
     match = _diff_tree_pattern.match(entry)
     if match:
-        return {
-            'src_mode': match.group(1),
-            'dst_mode': match.group(2),
-            'src_sha1': match.group(3),
-            'dst_sha1': match.group(4),
-            'status': match.group(5),
-            'status_score': match.group(6),
-            'src': PathQuoting.dequote(match.group(7)),
-            'dst': PathQuoting.dequote(match.group(10))
-        }
+        return DiffEntry(internMode(match.group(1)), internMode(match.group(2)), match.group(3), match.group(4), match.group(5),
+                         match.group(6), PathQuoting.dequote(match.group(7)), PathQuoting.dequote(match.group(8)))
     return None
 
 
@@ -209,11 +292,6 @@ P4.Revision.__repr__ = logrepr
 P4.Integration.__repr__ = logrepr
 P4.DepotFile.__repr__ = logrepr
 
-python3 = sys.version_info[0] >= 3
-if sys.hexversion < 0x02070000 or (0x0300000 <= sys.hexversion < 0x0303000):
-    sys.exit("Python 2.7 or 3.3 or newer is required to run this program.")
-reFetchMoveError = re.compile("Files are missing as a result of one or more move operations")
-
 # Although this should work with Python 3, it doesn't currently handle Windows Perforce servers
 # with filenames containing charaters such as umlauts etc: åäö
 
@@ -237,9 +315,8 @@ TARGET_SECTION = 'target'
 LOGGER_NAME = "GitP4Transfer"
 CHANGE_MAP_DESC = "Updated change_map_file"
 
-# This is for writing to sample config file
-yaml.preserve_quotes = True
-DEFAULT_CONFIG = yaml.load(r"""
+# This is for writing to sample config file - printed as is by --sample-config
+DEFAULT_CONFIG_YAML = r"""
 # counter_name: Unique counter on target server to use for recording source changes processed. No spaces.
 #    Name sensibly if you have multiple instances transferring into the same target p4 repository.
 #    The counter value represents the last transferred change number - script will start from next change.
@@ -277,7 +354,8 @@ mail_server:
 #     "7 * 24 * 60"
 # Such values should be quoted (in order to be treated as strings)
 # -------------------------------------------------------------------------------
-# sleep_on_error_interval (Integer): How long (in minutes) to sleep when error is encountered in the script
+# sleep_on_error_interval (Integer): Maximum time (in minutes) to sleep when error is encountered in the script.
+# Retries start after 1 second and the sleep doubles for each consecutive error up to this limit.
 sleep_on_error_interval: 60
 
 # poll_interval (Integer): How long (in minutes) to wait between polling source server for new changes
@@ -349,7 +427,12 @@ import_anon_branches: n
 #anon_branches_root: //git_import/temp_branches
 anon_branches_root:
 
-""")
+# use_pygit2: Set this to 'y' to diff merge commits in process using pygit2 (libgit2) when it is installed,
+#   rather than via git diff-tree. Much faster for large repos, but note that libgit2 rename detection
+#   may occasionally differ from git's.
+use_pygit2: n
+
+"""
 
 
 def ensureDirectory(directory):
@@ -368,14 +451,48 @@ def p4time(unixtime):
 
 
 def printSampleConfig():
-    "Print defaults from above dictionary for saving as a base file"
+    "Print defaults from above for saving as a base file - the text is printed as is, no need to parse it"
     print("")
     print("# Save this output to a file to e.g. transfer.yaml and edit it for your configuration")
-    print("")
-    yaml.dump(DEFAULT_CONFIG, sys.stdout)
+    print(DEFAULT_CONFIG_YAML, end="")
     sys.stdout.flush()
 
 
+def boundedPow(base, exponent):
+    "Power - with the exponent limited so a typo in a config value can't make us calculate an enormous number"
+    if abs(exponent) > 64:
+        raise ValueError("Exponent too large: %s" % exponent)
+    return operator.pow(base, exponent)
+
+
+_intExprOperators = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+                     ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+                     ast.Pow: boundedPow, ast.USub: operator.neg, ast.UAdd: operator.pos}
+
+
+@functools.lru_cache(maxsize=None)
+def evalIntExpression(expr):
+    """Evaluates simple arithmetic config values such as "7 * 24 * 60" or "20 * 2**20" - numbers and
+    + - * / // % ** only. Safe replacement for eval() - anything else raises ValueError.
+    As with int(eval()) the result is truncated, so "10/3" is 3"""
+    def evalNode(node):
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return node.value
+        if isinstance(node, ast.BinOp) and type(node.op) in _intExprOperators:
+            return _intExprOperators[type(node.op)](evalNode(node.left), evalNode(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _intExprOperators:
+            return _intExprOperators[type(node.op)](evalNode(node.operand))
+        raise ValueError("Unsupported expression: %s" % expr)
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError("Invalid expression: %s" % expr)
+    try:
+        return int(evalNode(tree.body))
+    except (ZeroDivisionError, OverflowError) as e:
+        raise ValueError("Invalid expression: %s: %s" % (expr, str(e)))
+
+
 def fmtsize(num):
     for x in ['bytes', 'KB', 'MB', 'GB', 'TB']:
         if num < 1024.0:
@@ -410,18 +527,27 @@ class PathQuoting:
 
     @staticmethod
     def dequote(quoted_string):
-        if quoted_string and quoted_string.startswith('"'):
-            assert quoted_string.endswith('"')
-            # Python3 - convert to bytes for magic above
-            quoted_string = quoted_string.encode()
-            result = PathQuoting._unescape_re.sub(PathQuoting.unescape_sequence,
-                                          quoted_string[1:-1])
-            return result.decode()
+        # Most paths are not quoted at all - so avoid the function call and cache lookup
+        if quoted_string and quoted_string[0] == '"':
+            return PathQuoting._dequote(quoted_string)
         return quoted_string
 
+    @staticmethod
+    @functools.lru_cache(maxsize=1 << 16)
+    def _dequote(quoted_string):
+        "Cached as the same paths recur across many commits"
+        assert quoted_string.endswith('"')
+        # Python3 - convert to bytes for magic above
+        quoted_string = quoted_string.encode()
+        result = PathQuoting._unescape_re.sub(PathQuoting.unescape_sequence,
+                                      quoted_string[1:-1])
+        return result.decode()
+
 
 class GitFileChanges():
     "Convenience class for file changes as part of a git commit"
+    # One of these per file per commit is held in memory for the whole run
+    __slots__ = ('modes', 'shas', 'changeTypes', 'filenames')
 
     def __init__(self, modes, shas, changeTypes, filenames) -> None:
         self.modes = modes
@@ -429,9 +555,22 @@ class GitFileChanges():
         self.changeTypes = changeTypes
         self.filenames = filenames
 
+    def isTree(self):
+        "Entries for directories are only present because getCommitDiffs uses -t"
+        return TREE_MODE in self.modes
+
+    def diffTreeEntry(self):
+        """Returns DiffEntry as parseDiffTreeEntry would for the equivalent diff-tree line.
+        Only valid for changes of a commit with a single parent (not combined diff format)"""
+        return DiffEntry(self.modes[0], self.modes[1], self.shas[0], self.shas[1],
+                         self.changeTypes[0], self.changeTypes[1:] or None, self.filenames[0],
+                         self.filenames[1] if len(self.filenames) > 1 else None)
+
 
 class GitCommit():
     "Convenience class for a git commit"
+    __slots__ = ('commitID', 'name', 'email', 'description', 'parents', 'fileChanges',
+                 'branch', 'parentBranch', 'firstOnBranch')
 
     def __init__(self, commitID, name, email, description) -> None:
         self.commitID = commitID
@@ -445,151 +584,237 @@ class GitCommit():
         self.firstOnBranch = False
 
 
+class GitDiffTreeBatch:
+    """Long running 'git diff-tree --stdin' process - avoids a fork/exec of git for every commit.
+    Each request is followed by a line which is not a valid object name. Git echoes such lines
+    straight back, so we know where the output for that request ends."""
+
+    endMarker = "__END_OF_DIFF__"
+
+    def __init__(self, logger, args) -> None:
+        self.logger = logger
+        self.cmd = ['git', 'diff-tree', '--stdin'] + args
+        self.proc = None
+
+    def start(self):
+        if self.logger:
+            self.logger.debug('Starting: %s' % ' '.join(self.cmd))
+        self.proc = subproc.PopenText(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def diff(self, commitID, parentID):
+        "Returns raw diff lines for commitID against parentID (equivalent of 'git diff-tree parent commit')"
+        return list(self.iterDiff(commitID, parentID))
+
+    def iterDiff(self, commitID, parentID):
+        """Generator version of diff - lines are parsed as git outputs them rather than all held in memory.
+        If not read to the end the process is stopped (and restarted by the next request)"""
+        if not self.proc:
+            self.start()
+        self.proc.stdin.write("%s %s\n%s\n" % (commitID, parentID, self.endMarker))
+        self.proc.stdin.flush()
+        finished = False
+        try:
+            for line in iter(self.proc.stdout.readline, ''):
+                if line.startswith(':'):
+                    yield line
+                elif line.rstrip('\n') == self.endMarker:
+                    finished = True
+                    return
+        finally:
+            if not finished:
+                self.close()
+        raise Exception('Command failed: %s' % ' '.join(self.cmd))
+
+    def close(self):
+        if self.proc:
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.proc = None
+
+
 class GitInfo:
     "Extract info about Git repo"
 
-    def __init__(self, logger) -> None:
+    def __init__(self, logger, usePygit2=False) -> None:
         self.logger = logger
         self.anonBranchInd = 0
-
-    def read_pipe_lines(self, c):
-        self.logger.debug('Reading pipe: %s\n' % str(c))
-
-        expand = not isinstance(c, list)
-        p = subprocess.Popen(c, stdout=subprocess.PIPE, shell=expand)
-        pipe = p.stdout
-        val = [decode_text_stream(line) for line in pipe.readlines()]
-        if pipe.close() or p.wait():
-            raise Exception('Command failed: %s' % str(c))
-        return val
+        self.diffTree = GitDiffTreeBatch(logger, ['-r', '-M'])
+        self.fileChangesTree = GitDiffTreeBatch(logger, ['-r'])
+        self.usePygit2 = bool(usePygit2 and importPygit2())
+        self.repo = None
+
+    def getRepo(self):
+        """Returns pygit2 repo (or None if not in use) - opened on first use rather than when constructed,
+        as like the git commands it is relative to the current directory which is only the git repo once replicating"""
+        if self.repo is None and self.usePygit2:
+            self.repo = pygit2.Repository('.')
+        return self.repo
+
+    def close(self):
+        "Stop any long running git processes"
+        self.diffTree.close()
+        self.fileChangesTree.close()
+        if self.repo:
+            self.repo.free()
+            self.repo = None
 
     def getCommitDiffs(self, refs):
         "Return array of commits in reverse order for processing, together with dict of commits"
+        commitList = []
+        commits = {}
+        for commit in self.iterCommitDiffs(refs):
+            commits[commit.commitID] = commit
+            commitList.append(commit.commitID)
+        return commitList, commits
+
+    def iterCommitDiffs(self, refs):
+        """Generator of commits in order for processing (as per getCommitDiffs) - each is yielded as soon as
+        git has output it, so callers which only need some of them need not read the whole history"""
         # Setup the rev-list/diff-tree process and read info about file diffs
         # Learned from git-filter-repo
-        cmd = ('git rev-list --first-parent --reverse {}'.format(' '.join(refs)) +
-                     ' | git diff-tree --stdin --always --root --format=%H%n%P%n%cn%n%ce%n%B%n"__END_OF_DESC__"%n%cd' +
-                     ' --date=iso-local -M -t -c --raw --combined-all-paths')
+        # The two processes are piped together directly rather than via a shell
+        revListCmd = ['git', 'rev-list', '--first-parent', '--reverse'] + list(refs)
+        diffTreeCmd = ['git', 'diff-tree', '--stdin', '--always', '--root',
+                       '--format=%H%n%P%n%cn%n%ce%n%cd%n%B%x00',
+                       '--date=iso-local', '-M', '-t', '-c', '--raw', '--combined-all-paths']
         if self.logger:
-            self.logger.debug(cmd)
-        dtp = subproc.Popen(cmd, shell=True, bufsize=-1, stdout=subprocess.PIPE)
+            self.logger.debug('%s | %s' % (' '.join(revListCmd), ' '.join(diffTreeCmd)))
+        rlp = subproc.Popen(revListCmd, stdout=subprocess.PIPE)
+        dtp = subproc.PopenText(diffTreeCmd, stdin=rlp.stdout, stdout=subprocess.PIPE)
+        rlp.stdout.close()  # So rev-list gets SIGPIPE if diff-tree exits early
         f = dtp.stdout
-        commitList = []
-        commits = {}
-        line = decode_text_stream(f.readline())
-        if not line:
-            return commitList, commits
+        readline = f.readline
+        line = readline()
         cont = bool(line)
 
-        while cont:
-            commitID = decode_text_stream(line).rstrip()
-            parents = decode_text_stream(f.readline()).split()
-            name = decode_text_stream(f.readline()).rstrip()
-            email = decode_text_stream(f.readline()).rstrip()
-            desc = []
-            in_desc = True
-            while in_desc:
-                line = decode_text_stream(f.readline()).rstrip()
-                if line.startswith('__END_OF_DESC__'):
-                    in_desc = False
-                elif line:
-                    desc.append(line)
-            date = decode_text_stream(f.readline()).rstrip()
-
-            # We expect a blank line next; if we get a non-blank line then
-            # this commit modified no files and we need to move on to the next.
-            # If there is no line, we've reached end-of-input.
-            line = decode_text_stream(f.readline())
-            if not line:
-                cont = False
-            line = line.rstrip()
-
-            # If we haven't reached end of input, and we got a blank line meaning
-            # a commit that has modified files, then get the file changes associated
-            # with this commit.
-            fileChanges = []
-            if cont and not line:
-                cont = False
+        try:
+            while cont:
+                commitID = line.rstrip()
+                parents = readline().split()
+                name = readline().rstrip()
+                email = readline().rstrip()
+                date = readline().rstrip()
+                # Description is terminated by a NUL - which unlike a marker line can't occur in the text.
+                # Blank lines are dropped from the description
+                desc = []
                 for line in f:
-                    line = decode_text_stream(line)
-                    if not line.startswith(':'):
-                        cont = True
+                    end = '\x00' in line
+                    if end:
+                        line = line[:line.index('\x00')]
+                    line = line.rstrip()
+                    if line:
+                        desc.append(line)
+                    if end:
                         break
+
+                # We expect a blank line next; if we get a non-blank line then
+                # this commit modified no files and we need to move on to the next.
+                # If there is no line, we've reached end-of-input.
+                line = readline()
+                if not line:
+                    cont = False
+                line = line.rstrip()
+
+                # If we haven't reached end of input, and we got a blank line meaning
+                # a commit that has modified files, then get the file changes associated
+                # with this commit.
+                fileChanges = []
+                if cont and not line:
+                    cont = False
+                    # Same for every line of this commit
                     n = 1 + max(1, len(parents))
-                    assert line.startswith(':'*(n-1))
-                    relevant = line[n-1:-1]
-                    splits = relevant.split(None, n)
-                    modes = splits[0:n]
-                    splits = splits[n].split(None, n)
-                    shas = splits[0:n]
-                    splits = splits[n].split('\t')
-                    change_types = splits[0]
-                    filenames = [PathQuoting.dequote(x) for x in splits[1:]]
-                    fileChanges.append(GitFileChanges(modes, shas, change_types, filenames))
-
-            commits[commitID] = GitCommit(commitID, name, email, '\n'.join(desc))
-            commits[commitID].parents = parents
-            commits[commitID].fileChanges = fileChanges
-            commitList.append(commitID)
-
-        # Close the output, ensure rev-list|diff-tree pipeline completed successfully
-        dtp.stdout.close()
-        if dtp.wait():
+                    prefix = ':'*(n-1)
+                    dequote = PathQuoting.dequote
+                    for line in f:
+                        if not line.startswith(':'):
+                            cont = True
+                            break
+                        assert line.startswith(prefix)
+                        relevant = line[n-1:-1]
+                        splits = relevant.split(None, n)
+                        modes = [internMode(m) for m in splits[0:n]]
+                        splits = splits[n].split(None, n)
+                        shas = splits[0:n]
+                        splits = splits[n].split('\t')
+                        change_types = sys.intern(splits[0])
+                        filenames = [dequote(x) for x in splits[1:]]
+                        fileChanges.append(GitFileChanges(modes, shas, change_types, filenames))
+
+                commit = GitCommit(commitID, name, email, '\n'.join(desc))
+                commit.parents = parents
+                commit.fileChanges = fileChanges
+                yield commit
+
+        finally:
+            # Close the output - if we stopped early git will get SIGPIPE and exit
+            dtp.stdout.close()
+            rlp.wait()  # As with the shell pipeline, only diff-tree status is checked (e.g. no commits yet is not an error)
+            rc = dtp.wait()
+        # Ensure rev-list|diff-tree pipeline completed successfully
+        if rc:
             raise SystemExit(("Error: rev-list|diff-tree pipeline failed; see above.")) # pragma: no cover
-        return commitList, commits
 
     def getFileChanges(self, commit):
         "Return file changes for a commit which is a merge - thus itself against its first parent"
-        cmd = ('git diff-tree -r {} {}'.format(commit.commitID, commit.parents[0]))
-        if self.logger:
-            self.logger.debug(cmd)
-        dtp = subproc.Popen(cmd, shell=True, bufsize=-1, stdout=subprocess.PIPE)
-        f = dtp.stdout
+        # Equivalent of 'git diff-tree -r <commit> <parent>' (note order) using a long running process.
+        # The batch process diffs each request against its 'parent', so the arguments are swapped.
         fileChanges = []
-        for line in f:
-            line = decode_text_stream(line)
-            if not line.startswith(':'):
-                continue
+        for line in self.fileChangesTree.iterDiff(commit.parents[0], commit.commitID):
             n = 2 # 1 + max(1, len(commit.parents))
             assert line.startswith(':'*(n-1))
             relevant = line[n-1:-1]
             splits = relevant.split(None, n)
-            modes = splits[0:n]
+            modes = [internMode(m) for m in splits[0:n]]
             splits = splits[n].split(None, n)
             shas = splits[0:n]
             splits = splits[n].split('\t')
-            change_types = splits[0]
+            change_types = sys.intern(splits[0])
             filenames = [PathQuoting.dequote(x) for x in splits[1:]]
             fileChanges.append(GitFileChanges(modes, shas, change_types, filenames))
-        dtp.stdout.close()
-        if dtp.wait():
-            raise SystemExit(("Error: {} failed; see above.".format(cmd))) # pragma: no cover
         return fileChanges
 
+    def getDiffEntries(self, commit):
+        """Returns diff entries (as per parseDiffTreeEntry) for commit against its first parent.
+        Ordinary commits reuse the file changes already read in bulk by getCommitDiffs so no git
+        process is required. Merges were read in combined format so are diffed individually."""
+        if len(commit.parents) == 1:
+            return [fc.diffTreeEntry() for fc in commit.fileChanges if not fc.isTree()]
+        if self.usePygit2:
+            return self.getPygit2DiffEntries(commit.parents[0], commit.commitID)
+        return [parseDiffTreeEntry(line) for line in self.diffTree.iterDiff(commit.commitID, commit.parents[0])]
+
+    def getPygit2DiffEntries(self, parentID, commitID):
+        """Equivalent of 'git diff-tree -r -M parent commit' without running git.
+        Note status_score is libgit2's similarity which is not calculated quite the same as git's"""
+        # Without the typechange flag a file <-> symlink change is reported as a delete and an add, not T
+        flags = pygit2.enums.DiffOption.INCLUDE_TYPECHANGE if hasattr(pygit2, 'enums') else pygit2.GIT_DIFF_INCLUDE_TYPECHANGE
+        diff = self.getRepo().diff(parentID, commitID, flags=flags)
+        diff.find_similar()
+        entries = []
+        for d in diff.deltas:
+            status = d.status_char()
+            if status in 'RC':
+                score, src, dst = '%03d' % d.similarity, d.old_file.path, d.new_file.path
+            else:
+                score, src, dst = None, d.new_file.path if status == 'A' else d.old_file.path, None
+            entries.append(DiffEntry(internMode('%06o' % d.old_file.mode), internMode('%06o' % d.new_file.mode),
+                                     str(d.old_file.id), str(d.new_file.id), status, score, src, dst))
+        return entries
+
     def getBranchCommits(self, branchRefs):
         "Returns a list of commit ids on the referenced branches"
         branchCommits = {}
         for b in branchRefs:
-            branchCommits[b] = []
-            cmd = ('git rev-list --first-parent {}'.format(b))
+            cmd = ['git', 'rev-list', '--first-parent', b]
             if self.logger:
-                self.logger.debug(cmd)
-            dtp = subproc.Popen(cmd, shell=True, bufsize=-1, stdout=subprocess.PIPE)
-            f = dtp.stdout
-            line = decode_text_stream(f.readline())
-            if not line:
-                return
-            cont = bool(line)
-            while cont:
-                commit = decode_text_stream(line).rstrip()
-                branchCommits[b].append(commit)
-                line = decode_text_stream(f.readline())
-                if not line:
-                    break
-
-        dtp.stdout.close()
-        if dtp.wait():
-            raise SystemExit("Error: {} failed; see above.".format(cmd)) # pragma: no cover
+                self.logger.debug(' '.join(cmd))
+            dtp = subproc.PopenText(cmd, stdout=subprocess.PIPE)
+            # Output is only commit ids, one per line, so read it in one go and split in C
+            branchCommits[b] = dtp.stdout.read().split()
+            dtp.stdout.close()
+            if dtp.wait():
+                raise SystemExit("Error: {} failed; see above.".format(' '.join(cmd))) # pragma: no cover
         return branchCommits
 
     # def updateBranchInfo(self, branchRefs, commitList, commits):
@@ -615,48 +840,6 @@ class GitInfo:
     #                 commits[id].branch = commits[firstParent].branch
 
 
-class ChangeRevision:
-    "Represents a change - created from P4API supplied information and thus encoding"
-
-    def __init__(self, rev, change, n):
-        self.rev = rev
-        self.action = change['action'][n]
-        self.type = change['type'][n]
-        self.depotFile = change['depotFile'][n]
-        self.localFile = None
-        self.fileSize = 0
-        self.digest = ""
-        self.fixedLocalFile = None
-
-
-    def depotFileRev(self):
-        "Fully specify depot file with rev number"
-        return "%s#%s" % (self.depotFile, self.rev)
-
-    def localFileRev(self):
-        "Fully specify local file with rev number"
-        return "%s#%s" % (self.localFile, self.rev)
-
-    def setLocalFile(self, localFile):
-        self.localFile = localFile
-        localFile = localFile.replace("%40", "@")
-        localFile = localFile.replace("%23", "#")
-        localFile = localFile.replace("%2A", "*")
-        localFile = localFile.replace("%25", "%")
-        localFile = localFile.replace("/", os.sep)
-        self.fixedLocalFile = localFile
-
-    def __repr__(self):
-        return 'rev={rev} action={action} type={type} size={size} digest={digest} depotFile={depotfile}' .format(
-            rev=self.rev,
-            action=self.action,
-            type=self.type,
-            size=self.fileSize,
-            digest=self.digest,
-            depotfile=self.depotFile,
-        )
-
-
 class P4Base(object):
     "Processes a config"
 
@@ -676,6 +859,10 @@ class P4Base(object):
         self.p4id = p4id
         self.p4 = None
         self.client_logged = 0
+        self.branchTargets = None
+        self.viewTemplates = None   # (client, templates) - see getClientView
+        self.syncedChange = None    # Head change when the have list was last known to be up to date - see P4Target.syncWorkspace
+        self.submittedChanges = set()   # Changes submitted by us since syncedChange
 
     def __str__(self):
         return '[section = {} P4PORT = {} P4CLIENT = {} P4USER = {} P4PASSWD = {} P4CHARSET = {}]'.format(
@@ -709,8 +896,13 @@ class P4Base(object):
         self.checkWarnings()
         return output
 
+    def ensureConnected(self, progname):
+        "Connect unless already connected - with --repeat the connection is kept between polls"
+        if not (self.p4 and self.p4.connected()):
+            self.connect(progname)
+
     def disconnect(self):
-        if self.p4:
+        if self.p4 and self.p4.connected():
             self.p4.disconnect()
 
     def checkWarnings(self):
@@ -720,60 +912,72 @@ class P4Base(object):
     # def resetWorkspace(self):
     #     self.p4cmd('sync', '//%s/...#none' % self.p4.P4CLIENT)
 
+    def logClientSpec(self, label, clientspec):
+        "Log clientspec (once) - pprint is slow so skipped if debug output is disabled"
+        if self.logger.isEnabledFor(logging.DEBUG):
+            import pprint
+            logOnce(self.logger, "%s %s:%s:%s" % (label, self.p4id, self.p4.client, pprint.pformat(clientspec)))
+
+    def getClientView(self, targ):
+        "Client view for targ depot path - only targ varies so the rest of each line is formatted once"
+        if not self.viewTemplates or self.viewTemplates[0] != self.p4.client:
+            templates = ["%%s/... //%s/..." % self.p4.client]
+            for exclude in ['.git/...']:
+                templates.append("-%%s/%s //%s/%s" % (exclude, self.p4.client, exclude))
+            self.viewTemplates = (self.p4.client, templates)
+        return [t % targ for t in self.viewTemplates[1]]
+
     def createClientWorkspace(self):
         """Create or adjust client workspace for target
         """
         clientspec = self.p4.fetch_client(self.p4.client)
-        logOnce(self.logger, "orig %s:%s:%s" % (self.p4id, self.p4.client, pprint.pformat(clientspec)))
+        self.logClientSpec("orig", clientspec)
 
         self.root = self.source.git_repo
         clientspec._root = self.root
         clientspec["Options"] = clientspec["Options"].replace("normdir", "rmdir")
         clientspec["Options"] = clientspec["Options"].replace("noallwrite", "allwrite")
         clientspec["LineEnd"] = "unix"
-        clientView = []
         v = self.options.branch_maps[0] # Start with first one - assume to be equivalent of master
-        line = "%s/... //%s/..." % (v['targ'], self.p4.client)
-        clientView.append(line)
-        for exclude in ['.git/...']:
-            line = "-%s/%s //%s/%s" % (v['targ'], exclude, self.p4.client, exclude)
-            clientView.append(line)
+        clientView = self.getClientView(v['targ'])
 
         clientspec._view = clientView
         self.clientmap = P4.Map(clientView)
         self.clientspec = clientspec
         self.p4.save_client(clientspec)
-        logOnce(self.logger, "updated %s:%s:%s" % (self.p4id, self.p4.client, pprint.pformat(clientspec)))
+        self.logClientSpec("updated", clientspec)
+        self.syncedChange = None    # View may have changed
 
         self.p4.cwd = self.root
         ctr = P4.Map('//"'+clientspec._client+'/..."   "' + clientspec._root + '/..."')
         self.localmap = P4.Map.join(self.clientmap, ctr)
         self.depotmap = self.localmap.reverse()
 
+    def getBranchTarget(self, branch):
+        "Returns targ for git branch as per branch_maps (first entry if repeated), or None"
+        if self.branchTargets is None:
+            self.branchTargets = {}
+            for v in self.options.branch_maps:
+                self.branchTargets.setdefault(v['git_branch'], v['targ'])
+        return self.branchTargets.get(branch)
+
     def updateClientWorkspace(self, branch):
         """ Adjust client workspace for new branch"""
         clientspec = self.p4.fetch_client(self.p4.client)
-        logOnce(self.logger, "orig %s:%s:%s" % (self.p4id, self.p4.client, pprint.pformat(clientspec)))
+        self.logClientSpec("orig", clientspec)
 
-        clientView = []
         if anonymousBranch(branch):
             targ = "%s/%s" % (self.options.anon_branches_root, branch)
         else:
-            for v in self.options.branch_maps:
-                if v['git_branch'] == branch:
-                    targ = v['targ']
-                    break
-        line = "%s/... //%s/..." % (targ, self.p4.client)
-        clientView.append(line)
-        for exclude in ['.git/...']:
-            line = "-%s/%s //%s/%s" % (targ, exclude, self.p4.client, exclude)
-            clientView.append(line)
+            targ = self.getBranchTarget(branch)
+        clientView = self.getClientView(targ)
 
         clientspec._view = clientView
         self.clientmap = P4.Map(clientView)
         self.clientspec = clientspec
         self.p4.save_client(clientspec)
-        logOnce(self.logger, "updated %s:%s:%s" % (self.p4id, self.p4.client, pprint.pformat(clientspec)))
+        self.logClientSpec("updated", clientspec)
+        self.syncedChange = None    # View may have changed
         self.logger.debug("Updated client view for branch: %s" % branch)
         ctr = P4.Map('//"'+clientspec._client+'/..."   "' + clientspec._root + '/..."')
         self.localmap = P4.Map.join(self.clientmap, ctr)
@@ -786,15 +990,11 @@ class P4Base(object):
         if anonymousBranch(origBranch):
             src = "%s/%s" % (self.options.anon_branches_root, origBranch)
         else:
-            for v in self.options.branch_maps:
-                if v['git_branch'] == origBranch:
-                    src = v['targ']
+            src = self.getBranchTarget(origBranch) or ""
         if anonymousBranch(newBranch):
             targ = "%s/%s" % (self.options.anon_branches_root, newBranch)
         else:
-            for v in self.options.branch_maps:
-                if v['git_branch'] == newBranch:
-                    targ = v['targ']
+            targ = self.getBranchTarget(newBranch) or ""
         line = "%s/... %s/..." % (src, targ)
         self.logger.debug("Map: %s" % line)
         branchMap = P4.Map(line)
@@ -809,24 +1009,26 @@ class GitSource(P4Base):
 
     def __init__(self, section, options):
         super(GitSource, self).__init__(section, options, 'src')
-        self.gitinfo = GitInfo(self.logger)
+        self.gitinfo = self.createGitInfo()
+
+    def createGitInfo(self):
+        return GitInfo(self.logger, usePygit2=(getattr(self.options, 'use_pygit2', 'n') == "y"))
 
     def run_cmd(self, cmd, dir=".", get_output=True, timeout=2*60*60, stop_on_error=True):
-        "Run cmd logging input and output"
+        """Run cmd logging input and output.
+        cmd may be a list of args (run directly) or a string (run via the shell)"""
         output = ""
+        shell = not isinstance(cmd, list)
         try:
-            self.logger.debug("Running: %s" % cmd)
+            self.logger.debug("Running: %s", cmd if shell else ' '.join(cmd))
             if get_output:
-                p = subprocess.Popen(cmd, cwd=dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, shell=True)
-                if python3:
-                    output, _ = p.communicate(timeout=timeout)
-                else:
-                    output, _ = p.communicate()
+                p = subproc.Popen(cmd, cwd=dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, shell=shell)
+                output, _ = p.communicate(timeout=timeout)
                 # rc = p.returncode
-                self.logger.debug("Output:\n%s" % output)
+                self.logger.debug("Output:\n%s", output)
             else:
-                result = subprocess.run(cmd, shell=True, check=True, capture_output=True)
-                self.logger.debug('Result: %s' % str(result))
+                result = subprocess.run(cmd, shell=shell, check=True, capture_output=True)
+                self.logger.debug('Result: %s', result)
         except subprocess.CalledProcessError as e:
             self.logger.debug("Output: %s" % e.output)
             if stop_on_error:
@@ -841,26 +1043,44 @@ class GitSource(P4Base):
                 raise e
         return output
 
+    def disconnect(self):
+        self.gitinfo.close()
+
     def missingCommits(self, counter):
         # self.gather_commits()
         branchRefs = [t['git_branch'] for t in self.options.branch_maps]
-        self.gitinfo = GitInfo(self.logger)
-        commitList, commits = self.gitinfo.getCommitDiffs(branchRefs)
-        try:
-            ind = commitList.index(counter)
-            commitList = commitList[ind+1:]
-        except ValueError:
-            pass
-        # self.gitinfo.updateBranchInfo(branchRefs, commitList, commits)
-        self.logger.debug("commits: %s" % ' '.join(commitList))
+        self.gitinfo.close()
+        self.gitinfo = self.createGitInfo()
         maxChanges = 0
         if self.options.change_batch_size:
             maxChanges = self.options.change_batch_size
         if self.options.maximum and self.options.maximum < maxChanges:
             maxChanges = self.options.maximum
-        if maxChanges > 0:
-            commitList = commitList[:maxChanges]
-        self.logger.debug('processing %d commits' % len(commitList))
+        # Process commits after counter (or from the start if it is not found), stopping
+        # as soon as we have a batch - so only the commits to be processed are kept.
+        commitList = []
+        commits = {}
+        foundCounter = False
+        commitIter = self.gitinfo.iterCommitDiffs(branchRefs)
+        try:
+            for commit in commitIter:
+                if commit.commitID == counter:
+                    foundCounter = True
+                    commitList = []
+                    commits = {}
+                    continue
+                if maxChanges > 0 and len(commitList) >= maxChanges:
+                    if foundCounter:
+                        break
+                    continue    # Have a batch from the start, but must keep looking for counter
+                commits[commit.commitID] = commit
+                commitList.append(commit.commitID)
+        finally:
+            commitIter.close()
+        # self.gitinfo.updateBranchInfo(branchRefs, commitList, commits)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("commits: %s" % ' '.join(commitList))
+        self.logger.debug('processing %d commits', len(commitList))
         self.commitList = commitList
         self.commits = commits
         return commitList, commits
@@ -868,17 +1088,19 @@ class GitSource(P4Base):
     def fileModified(self, filename):
         "Returns true if git thinks file has changed on disk"
         args = ['git', 'status', '-z', filename]
-        result = self.run_cmd(' '.join(args))
+        result = self.run_cmd(args)
         return len(result) > 0
 
     def checkoutCommit(self, commitID):
         """Expects change number as a string, and returns list of filerevs"""
         args = ['git', 'switch', '-C', tempBranch, commitID]
-        self.run_cmd(' '.join(args), get_output=False)
+        self.run_cmd(args, get_output=False)
 
 class P4Target(P4Base):
     "Functionality for transferring changes to target Perforce repository"
 
+    fileBatchSize = 500     # Max files per command for p4cmdFiles
+
     def __init__(self, section, options, source):
         super(P4Target, self).__init__(section, options, 'targ')
         self.source = source
@@ -887,11 +1109,7 @@ class P4Target(P4Base):
 
     def formatChangeDescription(self, **kwargs):
         """Format using specified format options - see call in replicateCommit"""
-        format = self.options.change_description_format
-        format = format.replace("\\n", "\n")
-        t = Template(format)
-        result = t.safe_substitute(**kwargs)
-        return result
+        return self.options.change_description_template.safe_substitute(**kwargs)
 
     def ignoreFile(self, fname):
         "Returns True if file is to be ignored"
@@ -902,28 +1120,17 @@ class P4Target(P4Base):
                 return True
         return False
     
+    def p4cmdFiles(self, cmd, options, files):
+        "Run cmd for a list of files in batches - far fewer server round trips than a command per file"
+        for i in range(0, len(files), self.fileBatchSize):
+            self.p4cmd(cmd, options, files[i:i + self.fileBatchSize])
+
     def p4_integrate(self, src, dest):
         self.p4cmd("integrate", "-Dt", wildcard_encode(src), wildcard_encode(dest))
 
     # def p4_sync(f, *options):
     #     p4_system(["sync"] + list(options) + [wildcard_encode(f)])
 
-    def p4_add(self, f):
-        # forcibly add file names with wildcards
-        if wildcard_present(f):
-            self.p4cmd("add", "-f", f)
-        else:
-            self.p4cmd("add", f)
-
-    def p4_delete(self, f):
-        self.p4cmd("delete", wildcard_encode(f))
-
-    def p4_edit(self, f, *options):
-        self.p4cmd("edit", options, wildcard_encode(f))
-
-    def p4_revert(self, f):
-        self.p4cmd("revert", wildcard_encode(f))
-
     def p4_reopen(self, type, f):
         self.p4cmd("reopen", "-t", type, wildcard_encode(f))
 
@@ -934,8 +1141,44 @@ class P4Target(P4Base):
     def p4_move(self, src, dest):
         self.p4cmd("move", "-k", wildcard_encode(src), wildcard_encode(dest))
 
-    def replicateCommit(self, commit):
-        """This is the heart of it all. Replicate a single commit/change"""
+    def syncWorkspace(self):
+        """sync -k unless the have list is known to be up to date. Submitting updates the have list
+        so it only needs doing when changes have been submitted by others - checking for that is
+        much cheaper for the server than sync walking the whole have list"""
+        clientFiles = '//%s/...' % self.p4.client
+        if self.syncedChange is not None:
+            chgs = self.p4cmd('changes', '-ssubmitted', '%s@>%s' % (clientFiles, self.syncedChange))
+            if all(c['change'] in self.submittedChanges for c in chgs):
+                if chgs:    # All ours - so the have list is up to date as of the latest
+                    self.syncedChange = max(chgs, key=lambda c: int(c['change']))['change']
+                    self.submittedChanges.clear()
+                return
+        # Head is read before syncing - anything submitted in between is synced but will be seen next time
+        # as not ours, so is synced again rather than missed
+        head = self.p4cmd('changes', '-m1', '-ssubmitted', clientFiles)
+        self.p4cmd('sync', '-k')
+        self.syncedChange = head[0]['change'] if head else '0'
+        self.submittedChanges.clear()
+
+    def removeWorkspaceFile(self, path):
+        if self.isWindows:
+            # turn off read-only attribute
+            os.chmod(path, stat.S_IWRITE)
+        os.unlink(path)
+
+    def getCommitChanges(self, commit):
+        """Returns (fileChanges, diffEntries) for commit - the git side of replicateCommit.
+        Only reads from git so may be run for the next commit while the current one is submitted"""
+        fileChanges = commit.fileChanges
+        if not fileChanges or any(f.changeTypes == 'MM' for f in fileChanges):
+            # Do a git diff-tree to make sure we detect files changed on the target branch rather than just dirs
+            fileChanges = self.source.gitinfo.getFileChanges(commit)
+        diffEntries = self.source.gitinfo.getDiffEntries(commit) if commit.parents else None
+        return fileChanges, diffEntries
+
+    def replicateCommit(self, commit, changes=None):
+        """This is the heart of it all. Replicate a single commit/change.
+        changes is the result of getCommitChanges if already fetched"""
 
         self.filesToIgnore = []
         # Branch processing currently removed for now.
@@ -977,28 +1220,21 @@ class P4Target(P4Base):
         #             raise P4TLogicException('Action not yet implemented: %s', fc.changeTypes)
         #     self.currentBranch = commit.branch
         # else:
-        self.p4cmd('sync', '-k')
-        fileChanges = commit.fileChanges
-        if not fileChanges or (0 < len([f for f in fileChanges if f.changeTypes == 'MM'])):
-            # Do a git diff-tree to make sure we detect files changed on the target branch rather than just dirs
-            fileChanges = self.source.gitinfo.getFileChanges(commit)
-        
+        self.syncWorkspace()
+        fileChanges, diffEntries = changes or self.getCommitChanges(commit)
+
         if not commit.parents:
+            recFlags = {'A': '-af', 'M': '-e', 'D': '-d'}
+            recFiles = collections.defaultdict(list)
             for fc in fileChanges:
-                self.logger.debug("fileChange: %s %s" % (fc.changeTypes, fc.filenames[0]))
+                self.logger.debug("fileChange: %s %s", fc.changeTypes, fc.filenames[0])
                 if fc.filenames[0]:
-                    filename = PathQuoting.dequote(fc.filenames[0])
-                    if fc.changeTypes == 'A':
-                        self.p4cmd('rec', '-af', filename)
-                    elif fc.changeTypes == 'M':
-                        self.p4cmd('rec', '-e', filename)
-                    elif fc.changeTypes == 'D':
-                        self.p4cmd('rec', '-d', filename)
-                    else: # Better safe than sorry! Various known actions not yet implemented
+                    if fc.changeTypes not in recFlags: # Better safe than sorry! Various known actions not yet implemented
                         raise P4TLogicException('Action not yet implemented: %s', fc.changeTypes)
+                    recFiles[fc.changeTypes].append(PathQuoting.dequote(fc.filenames[0]))
+            for changeType, files in recFiles.items():
+                self.p4cmdFiles('rec', [recFlags[changeType]], files)
         else:
-            diff = self.source.gitinfo.read_pipe_lines("git diff-tree -r %s \"%s^\" \"%s\"" % (
-                        "-M", commit.commitID, commit.commitID))
             filesToAdd = set()
             filesToChangeType = set()
             filesToDelete = set()
@@ -1006,68 +1242,70 @@ class P4Target(P4Base):
             pureRenameCopy = set()
             symlinks = set()
             filesToChangeExecBit = {}
-            all_files = list()
-
-            for line in diff:
-                diff = parseDiffTreeEntry(line)
-                modifier = diff['status']
-                path = diff['src']
-                all_files.append(path)
+            pendingEdits = set()    # Opened for edit in one batch after all diffs are processed
+            copiedFiles = []        # Removed from the workspace once pendingEdits are opened
+
+            # Rename sources must be open before move but may not exist - open them all in one go
+            self.p4cmdFiles("edit", ["-k"], [wildcard_encode(diff.src) for diff in diffEntries if diff.status == "R"])
+            for diff in diffEntries:
+                modifier = diff.status
+                path = diff.src
+                dst_mode = diff.dst_mode
+                # Modes are interned strings so unchanged ones are rejected without parsing
+                execChanged = diff.src_mode != dst_mode and isModeExecChanged(diff.src_mode, dst_mode)
 
                 if modifier == "M":
-                    self.p4_edit(path)
-                    if isModeExecChanged(diff['src_mode'], diff['dst_mode']):
-                        filesToChangeExecBit[path] = diff['dst_mode']
+                    pendingEdits.add(path)
+                    if execChanged:
+                        filesToChangeExecBit[path] = dst_mode
                     editedFiles.add(path)
                 elif modifier == "A":
                     filesToAdd.add(path)
-                    filesToChangeExecBit[path] = diff['dst_mode']
+                    filesToChangeExecBit[path] = dst_mode
                     if path in filesToDelete:
                         filesToDelete.remove(path)
-                    dst_mode = int(diff['dst_mode'], 8)
-                    if dst_mode == 0o120000:
+                    if dst_mode == '120000':
                         symlinks.add(path)
                 elif modifier == "D":
                     filesToDelete.add(path)
                     if path in filesToAdd:
                         filesToAdd.remove(path)
                 elif modifier == "C":
-                    src, dest = diff['src'], diff['dst']
-                    all_files.append(dest)
+                    src, dest = diff.src, diff.dst
                     self.p4_integrate(src, dest)
                     pureRenameCopy.add(dest)
-                    if diff['src_sha1'] != diff['dst_sha1']:
-                        self.p4_edit(dest)
+                    if diff.src_sha1 != diff.dst_sha1:
+                        pendingEdits.add(dest)
                         pureRenameCopy.discard(dest)
-                    if isModeExecChanged(diff['src_mode'], diff['dst_mode']):
-                        self.p4_edit(dest)
+                    if execChanged:
+                        pendingEdits.add(dest)
                         pureRenameCopy.discard(dest)
-                        filesToChangeExecBit[dest] = diff['dst_mode']
-                    if self.isWindows:
-                        # turn off read-only attribute
-                        os.chmod(dest, stat.S_IWRITE)
-                    os.unlink(dest)
+                        filesToChangeExecBit[dest] = dst_mode
+                    copiedFiles.append(dest)
                     editedFiles.add(dest)
                 elif modifier == "R":
-                    src, dest = diff['src'], diff['dst']
-                    all_files.append(dest)
-                    self.p4_edit(src, "-k")  # src must be open before move but may not exist
+                    src, dest = diff.src, diff.dst
                     self.p4_move(src, dest)  # opens for (move/delete, move/add)
-                    if isModeExecChanged(diff['src_mode'], diff['dst_mode']):
-                        filesToChangeExecBit[dest] = diff['dst_mode']
+                    if execChanged:
+                        filesToChangeExecBit[dest] = dst_mode
                     editedFiles.add(dest)
                 elif modifier == "T":
                     filesToChangeType.add(path)
                 else:
                     raise Exception("unknown modifier %s for %s" % (modifier, path))
         
-            for f in filesToChangeType:
-                self.p4_edit(f, "-t", "auto")
-            for f in filesToAdd:
-                self.p4_add(f)
-            for f in filesToDelete:
-                self.p4_revert(f)
-                self.p4_delete(f)
+            # Files are opened in batches rather than one command per file
+            self.p4cmdFiles("edit", [], [wildcard_encode(f) for f in sorted(pendingEdits)])
+            # Copy targets are opened (integrate, plus edit above if modified) before being removed
+            for dest in copiedFiles:
+                self.removeWorkspaceFile(dest)
+            self.p4cmdFiles("edit", ["-t", "auto"], [wildcard_encode(f) for f in sorted(filesToChangeType)])
+            # forcibly add file names with wildcards
+            self.p4cmdFiles("add", ["-f"], [f for f in sorted(filesToAdd) if wildcard_present(f)])
+            self.p4cmdFiles("add", [], [f for f in sorted(filesToAdd) if not wildcard_present(f)])
+            deletes = [wildcard_encode(f) for f in sorted(filesToDelete)]
+            self.p4cmdFiles("revert", [], deletes)
+            self.p4cmdFiles("delete", [], deletes)
 
             # Set/clear executable bits
             # TODO
@@ -1077,51 +1315,51 @@ class P4Target(P4Base):
 
         openedFiles = self.p4cmd('opened')
         lenOpenedFiles = len(openedFiles)
-        if lenOpenedFiles > 0:
-            self.logger.debug("Opened files: %d" % lenOpenedFiles)
-            # self.fixFileTypes(fileRevs, openedFiles)
-            description = self.formatChangeDescription(
-                sourceDescription=commit.description,
-                sourceChange=commit.commitID, sourcePort='git_repo',
-                sourceUser=commit.name)
-            newChangeId = 0
-            result = None
-            try:
-                # Debug for larger changelists
-                if lenOpenedFiles > 1000:
-                    self.logger.debug("About to fetch change")
-                chg = self.p4.fetch_change()
-                chg['Description'] = description
-                if lenOpenedFiles > 1000:
-                    self.logger.debug("About to submit")
-                result = self.p4.save_submit(chg)
-                a = -1
-                while 'submittedChange' not in result[a]:
-                    a -= 1
-                newChangeId = result[a]['submittedChange']
-                if lenOpenedFiles > 1000:
-                    self.logger.debug("submitted")
-                self.logger.debug(self.p4id, result)
-                self.checkWarnings()
-            except P4.P4Exception as e:
-                raise e
-
-            if newChangeId:
-                self.logger.info("source = {} : target  = {}".format(commit.commitID, newChangeId))
-                description = self.formatChangeDescription(
-                    sourceDescription=commit.description,
-                    sourceChange=commit.commitID, sourcePort='git_repo',
-                    sourceUser=commit.name)
-                self.updateChange(newChangeId=newChangeId, description=description)
-            else:
-                self.logger.error("failed to replicate change {}".format(commit))
-            return newChangeId
+        if not lenOpenedFiles:
+            # Nothing to submit, e.g. an empty commit - skip fetching and submitting a change
+            self.logger.info("No files opened for commit %s" % commit.commitID)
+            return 0
+        self.logger.debug("Opened files: %d", lenOpenedFiles)
+        # self.fixFileTypes(fileRevs, openedFiles)
+        description = self.formatChangeDescription(
+            sourceDescription=commit.description,
+            sourceChange=commit.commitID, sourcePort='git_repo',
+            sourceUser=commit.name)
+        newChangeId = 0
+        result = None
+        try:
+            # Debug for larger changelists
+            if lenOpenedFiles > 1000:
+                self.logger.debug("About to fetch change")
+            chg = self.p4.fetch_change()
+            chg['Description'] = description
+            if lenOpenedFiles > 1000:
+                self.logger.debug("About to submit")
+            result = self.p4.save_submit(chg)
+            newChangeId = next((r['submittedChange'] for r in reversed(result)
+                                if isinstance(r, dict) and 'submittedChange' in r), 0)
+            if lenOpenedFiles > 1000:
+                self.logger.debug("submitted")
+            self.logger.debug(self.p4id, result)
+            self.checkWarnings()
+        except P4.P4Exception as e:
+            raise e
+
+        if newChangeId:
+            self.submittedChanges.add(str(newChangeId))
+            self.logger.info("source = {} : target  = {}".format(commit.commitID, newChangeId))
+            self.updateChange(newChangeId=newChangeId, description=description)
+        else:
+            self.logger.error("failed to replicate change {}".format(commit))
+        return newChangeId
 
     def updateChange(self, newChangeId, description):
         # need to update the user and time stamp - but only if a superuser
         if not self.options.superuser == "y":
             return
         newChange = self.p4.fetch_change(newChangeId)
+        if newChange._description.rstrip() == description.rstrip():
+            return  # Stored as submitted (e.g. not altered by a trigger) - no need to save it again
         newChange._description = description
         self.p4.save_change(newChange, '-f')
 
@@ -1162,7 +1400,7 @@ class GitP4Transfer(object):
                             help="Validate config file and setup source/target workspaces but don't transfer anything")
         parser.add_argument('-m', '--maximum', default=None, type=int, help="Maximum number of changes to transfer")
         parser.add_argument('-r', '--repeat', action='store_true',
-                            help="Repeat transfer in a loop - for continuous transfer as background task")
+                            help="Repeat transfer in a loop - for continuous transfer as background task. On Linux send SIGHUP to poll immediately")
         parser.add_argument('-s', '--stoponerror', action='store_true', help="Stop on any error even if --repeat has been specified")
         parser.add_argument('--sample-config', action='store_true', help="Print an example config file and exit")
         parser.add_argument('--end-datetime', type=valid_datetime_type, default=None,
@@ -1176,6 +1414,10 @@ class GitP4Transfer(object):
 
         self.logger = logutils.getLogger(LOGGER_NAME)
         self.previous_target_change_counter = 0     # Current value
+        self.configFileKey = None   # (mtime, size) of config file when last successfully read
+        self.source = None
+        self.target = None
+        self.wakeSignals = None     # Signals which end a sleep between polls early - see installWakeHandler
 
     def getOption(self, section, option_name, default=None):
         result = default
@@ -1195,14 +1437,20 @@ class GitP4Transfer(object):
             return val
         if val:
             try:
-                result = int(eval(val))
-            except Exception:
-                pass
+                result = evalIntExpression(str(val))
+            except Exception as e:
+                self.logger.error("Invalid value for option %s: '%s' (%s) - using default %s", option_name, val, e, default)
         return result
 
     def readConfig(self):
-        self.config = {}
         try:
+            # With --repeat this is called every poll - if the file is unchanged there is nothing to do,
+            # and the existing source and target (including the target's connection) are kept
+            st = os.stat(self.options.config)
+            key = (st.st_mtime_ns, st.st_size)
+            if key == self.configFileKey and self.target:
+                return
+            self.config = {}
             with open(self.options.config) as f:
                 self.config = yaml.load(f)
         except Exception as e:
@@ -1227,6 +1475,8 @@ class GitP4Transfer(object):
         self.options.change_description_format = self.getOption(
             GENERAL_SECTION, "change_description_format",
             "$sourceDescription\n\nTransferred from git://$sourceRepo@$sourceChange")
+        # Built once here rather than for every change formatted
+        self.options.change_description_template = Template(self.options.change_description_format.replace("\\n", "\n"))
         self.options.superuser = self.getOption(GENERAL_SECTION, "superuser", "y")
         self.options.branch_maps = self.getOption(GENERAL_SECTION, "branch_maps")
         if not self.options.branch_maps:
@@ -1234,6 +1484,9 @@ class GitP4Transfer(object):
         self.options.anon_branches_root = self.getOption(GENERAL_SECTION, "anon_branches_root")
         self.options.import_anon_branches = self.getOption(GENERAL_SECTION, "import_anon_branches", "n")
         self.options.ignore_files = self.getOption(GENERAL_SECTION, "ignore_files")
+        self.options.use_pygit2 = self.getOption(GENERAL_SECTION, "use_pygit2", "n")
+        if self.options.use_pygit2 == "y" and not importPygit2():
+            errors.append("Option use_pygit2 requires the pygit2 module to be installed")
         self.options.re_ignore_files = []
         if self.options.ignore_files:
             for exp in self.options.ignore_files:
@@ -1244,11 +1497,15 @@ class GitP4Transfer(object):
         if errors:
             raise P4TConfigException("\n".join(errors))
 
+        if self.target:
+            self.source.disconnect()
+            self.target.disconnect()
         self.source = GitSource(SOURCE_SECTION, self.options)
         self.target = P4Target(TARGET_SECTION, self.options, self.source)
 
         self.readOption('git_repo', self.source)
         self.readP4Section(self.target)
+        self.configFileKey = key    # Only once valid - so an invalid file is read (and reported) again
 
     def readP4Section(self, p4config):
         if p4config.section in self.config:
@@ -1278,7 +1535,7 @@ class GitP4Transfer(object):
     def replicate_commits(self):
         "Perform a replication loop"
         os.chdir(self.source.git_repo)
-        self.target.connect('target replicate')
+        self.target.ensureConnected('target replicate')
         self.target.createClientWorkspace()
         commitIDs, commits = self.source.missingCommits(self.target.getCounter())
         if self.options.notransfer:
@@ -1290,24 +1547,31 @@ class GitP4Transfer(object):
             self.save_previous_target_change_counter()
             self.checkRotateLogFile()
             self.revertOpenedFiles()
-            for id in commitIDs:
-                if self.endDatetimeExceeded():  # Bail early
-                    self.logger.info("Transfer stopped due to --end-datetime being exceeded")
-                    return changesTransferred
-                msg = 'Processing commit: {}'.format(id)
-                self.logger.info(msg)
-                commit = commits[id]
-                self.source.checkoutCommit(id)
-                self.target.replicateCommit(commit)
-                self.target.setCounter(id)
-                changesTransferred += 1
-        self.target.disconnect()
+            # git diffs for the next commit are read by a single background thread while the current
+            # one is checked out and submitted. The thread is the only user of the git diff processes.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+                nextChanges = prefetcher.submit(self.target.getCommitChanges, commits[commitIDs[0]])
+                for i, id in enumerate(commitIDs):
+                    if self.endDatetimeExceeded():  # Bail early
+                        self.logger.info("Transfer stopped due to --end-datetime being exceeded")
+                        break   # Not return - the git processes are stopped by source.disconnect() below
+                    msg = 'Processing commit: {}'.format(id)
+                    self.logger.info(msg)
+                    commit = commits[id]
+                    changes = nextChanges.result()
+                    if i + 1 < len(commitIDs):
+                        nextChanges = prefetcher.submit(self.target.getCommitChanges, commits[commitIDs[i + 1]])
+                    self.source.checkoutCommit(id)
+                    self.target.replicateCommit(commit, changes)
+                    self.target.setCounter(id)
+                    changesTransferred += 1
+        self.source.disconnect()
         return changesTransferred
 
     def log_exception(self, e):
         "Log exceptions appropriately"
         etext = str(e)
-        if re.search("WSAETIMEDOUT", etext, re.MULTILINE) or re.search("WSAECONNREFUSED", etext, re.MULTILINE):
+        if "WSAETIMEDOUT" in etext or "WSAECONNREFUSED" in etext:
             self.logger.error(etext)
         else:
             self.logger.exception(e)
@@ -1321,32 +1585,30 @@ class GitP4Transfer(object):
     def send_summary_email(self, time_last_summary_sent, change_last_summary_sent):
         "Send an email summarising changes transferred"
         time_str = p4time(time_last_summary_sent)
-        self.target.connect('target replicate')
-        # Combine changes reported by time or since last changelist transferred
-        changes = self.target.p4cmd('changes', '-l', '//{client}/...@{rev},#head'.format(
-                client=self.target.P4CLIENT, rev=time_str))
-        chgnums = [chg['change'] for chg in changes]
-        counter_changes = self.target.p4cmd('changes', '-l', '//{client}/...@{rev},#head'.format(
-                client=self.target.P4CLIENT, rev=change_last_summary_sent))
-        for chg in counter_changes:
-            if chg['change'] not in chgnums:
-                changes.append(chg)
+        self.target.ensureConnected('target replicate')
+        # Combine changes reported by time or since last changelist transferred - a single changes
+        # command with both filespecs lists each change once, rather than two commands merged here
+        changes = self.target.p4cmd('changes', '-l', *['//{client}/...@{rev},#head'.format(
+                client=self.target.P4CLIENT, rev=rev) for rev in (time_str, change_last_summary_sent)])
         changes.reverse()
         lines = []
         lines.append(["Date", "Time", "Changelist", "File Revisions", "Size (bytes)", "Size"])
         total_changes = 0
         total_rev_count = 0
         total_file_sizes = 0
-        for chg in changes:
-            sizes = self.target.p4cmd('sizes', '-s', '//%s/...@%s,%s' % (self.target.P4CLIENT,
-                                                                         chg['change'], chg['change']))
+        # One sizes command with a filespec per change (a summary is returned for each) rather than a command per change
+        specs = ['//%s/...@%s,%s' % (self.target.P4CLIENT, chg['change'], chg['change']) for chg in changes]
+        allSizes = self.target.p4cmd('sizes', '-s', specs) if specs else []
+        if len(allSizes) != len(specs):
+            allSizes = [self.target.p4cmd('sizes', '-s', spec)[0] for spec in specs]
+        for chg, sizes in zip(changes, allSizes):
             lines.append([time.strftime("%Y/%m/%d", time.localtime(int(chg['time']))),
                          time.strftime("%H:%M:%S", time.localtime(int(chg['time']))),
-                         chg['change'], sizes[0]['fileCount'], sizes[0]['fileSize'],
-                         fmtsize(int(sizes[0]['fileSize']))])
+                         chg['change'], sizes['fileCount'], sizes['fileSize'],
+                         fmtsize(int(sizes['fileSize']))])
             total_changes += 1
-            total_rev_count += int(sizes[0]['fileCount'])
-            total_file_sizes += int(sizes[0]['fileSize'])
+            total_rev_count += int(sizes['fileCount'])
+            total_file_sizes += int(sizes['fileSize'])
         lines.append([])
         lines.append(['Totals', '', str(total_changes), str(total_rev_count), str(total_file_sizes), fmtsize(total_file_sizes)])
         report = "Changes transferred since %s\n%s" % (
@@ -1355,7 +1617,6 @@ class GitP4Transfer(object):
         self.logger.info("Sending Transfer summary report")
         self.logger.notify("Transfer summary report", report, include_output=False)
         self.save_previous_target_change_counter()
-        self.target.disconnect()
 
     def validateConfig(self):
         "Performs appropriate validation of config values - primarily streams"
@@ -1381,8 +1642,7 @@ class GitP4Transfer(object):
         "Rotate existing log file"
         self.logger.info("Rotating logfile")
         logutils.resetLogger(LOGGER_NAME)
-        global alreadyLogged
-        alreadyLogged = {}
+        alreadyLogged.clear()
         self.writeLogHeader()
 
     def checkRotateLogFile(self):
@@ -1396,6 +1656,22 @@ class GitP4Transfer(object):
         except Exception as e:
             self.log_exception(e)
 
+    def installWakeHandler(self):
+        """With --repeat, SIGHUP wakes the transfer to poll immediately rather than waiting for poll_interval.
+        SIGHUP is blocked and only accepted by sigtimedwait in sleep() - no handler runs asynchronously,
+        and one sent while transferring is left pending so the next sleep returns straight away"""
+        if not hasattr(signal, 'sigtimedwait'):   # Windows and macOS
+            return
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGHUP})
+        self.wakeSignals = {signal.SIGHUP}
+
+    def sleep(self, minutes):
+        "Sleep unless woken by installWakeHandler"
+        if self.wakeSignals:
+            signal.sigtimedwait(self.wakeSignals, minutes * 60)
+        else:
+            time.sleep(minutes * 60)
+
     def endDatetimeExceeded(self):
         """Determine if we should stop due to this being set"""
         if not self.options.end_datetime:
@@ -1416,12 +1692,16 @@ class GitP4Transfer(object):
             return 1
 
         self.options.config = os.path.realpath(self.options.config)
+        if self.options.repeat:
+            self.installWakeHandler()
 
         time_last_summary_sent = time.time()
         change_last_summary_sent = 0
-        self.logger.debug("Time last summary sent: %s" % p4time(time_last_summary_sent))
-        time_last_error_occurred = 0
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Time last summary sent: %s" % p4time(time_last_summary_sent))
+        time_last_error_occurred = 0   # time.monotonic() - only used for intervals
         error_encountered = False   # Flag to indicate error encountered which may require reporting
+        error_backoff = 1           # Seconds to sleep after next error - doubles up to sleep_on_error_interval
         error_notified = False
         finished = False
         num_changes = 0
@@ -1436,8 +1716,8 @@ class GitP4Transfer(object):
                 logOnce(self.logger, self.source.options)
                 logOnce(self.logger, self.target.options)
                 self.source.disconnect()
-                self.target.disconnect()
                 num_changes = self.replicate_commits()
+                error_backoff = 1
                 if self.options.notransfer:
                     finished = True
                 if num_changes > 0:
@@ -1458,10 +1738,11 @@ class GitP4Transfer(object):
                         self.logger.notify("Cleared error", "Previous error has now been cleared")
                         error_encountered = False
                         error_notified = False
-                    if time.time() - time_last_summary_sent > self.options.summary_report_interval * 60:
-                        time_last_summary_sent = time.time()
+                    now = time.time()
+                    if now - time_last_summary_sent > self.options.summary_report_interval * 60:
+                        time_last_summary_sent = now
                         self.send_summary_email(time_last_summary_sent, change_last_summary_sent)
-                    time.sleep(self.options.poll_interval * 60)
+                    self.sleep(self.options.poll_interval)
                     self.logger.info("Sleeping for %d minutes" % self.options.poll_interval)
             except P4TException as e:
                 self.log_exception(e)
@@ -1470,6 +1751,7 @@ class GitP4Transfer(object):
                 return 1
             except Exception as e:
                 self.log_exception(e)
+                self.target.disconnect()    # State of connection unknown - reconnect next time round
                 if self.options.stoponerror:
                     self.logger.notify("Error", "Exception encountered and --stoponerror specified")
                     logging.shutdown()
@@ -1478,20 +1760,26 @@ class GitP4Transfer(object):
                     # Decide whether to report an error
                     if not error_encountered:
                         error_encountered = True
-                        time_last_error_occurred = time.time()
+                        time_last_error_occurred = time.monotonic()
                     elif not error_notified:
-                        if time.time() - time_last_error_occurred > self.options.error_report_interval * 60:
+                        if time.monotonic() - time_last_error_occurred > self.options.error_report_interval * 60:
                             error_notified = True
                             self.logger.info("Logging - Notifying recurring error")
                             self.logger.notify("Recurring error", "Multiple errors seen")
-                    self.logger.info("Sleeping on error for %d minutes" % self.options.sleep_on_error_interval)
-                    time.sleep(self.options.sleep_on_error_interval * 60)
+                    # Retry quickly at first in case the error was transient (e.g. server restart)
+                    sleepSeconds = min(error_backoff, self.options.sleep_on_error_interval * 60)
+                    error_backoff *= 2
+                    self.logger.info("Sleeping on error for %d seconds" % sleepSeconds)
+                    self.sleep(sleepSeconds / 60)
+        self.target.disconnect()
         self.logger.notify("Changes transferred", "Completed successfully")
         logging.shutdown()
         return 0
 
 
 if __name__ == '__main__':
+    if sys.hexversion < 0x03070000:
+        sys.exit("Python 3.7 or newer is required to run this program.")
     result = 0
     try:
         prog = GitP4Transfer(*sys.argv[1:])
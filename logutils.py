@@ -16,7 +16,6 @@ import os
 import time
 import logging
 import smtplib
-import requests
 from email.mime.text import MIMEText
 
 python3 = sys.version_info[0] >= 3
@@ -52,7 +51,8 @@ def notify_users_by_form(mail_form_url, subject, msg):
     response = None
     try:
         if "api" in mail_form_url:
-            # Mailgun API
+            # Mailgun API - requests is only imported when needed as it is slow to import
+            import requests
             requests.post("%s/messages" % mail_form_url["url"],
                           auth=("api", mail_form_url["api"]),
                           data={"from": mail_form_url["mail_from"],
@@ -8,14 +8,11 @@ import time
 import P4
 import subprocess
 import inspect
-import platform
-from textwrap import dedent
 import unittest
 import os
 import shutil
 import stat
 import re
-import glob
 import argparse
 import datetime
 from ruamel.yaml import YAML
@@ -40,6 +37,13 @@ P4D = "p4d"     # This can be overridden via command line stuff
 P4USER = "testuser"
 P4CLIENT = "test_ws"
 TEST_ROOT = '_testrun_transfer'
+# Separate test tree per pytest-xdist worker (pytest -n auto) so parallel runs don't collide
+if os.environ.get('PYTEST_XDIST_WORKER'):
+    TEST_ROOT = '%s_%s' % (TEST_ROOT, os.environ['PYTEST_XDIST_WORKER'])
+# Set GITP4_TEST_ROOT to a directory (e.g. /dev/shm) to create the test tree under it, e.g. on a RAM disk.
+# The tree is always a subdirectory of its own, as it is deleted by each test.
+if os.environ.get('GITP4_TEST_ROOT'):
+    TEST_ROOT = os.path.join(os.environ['GITP4_TEST_ROOT'], TEST_ROOT)
 TRANSFER_CLIENT = "transfer"
 TRANSFER_TARGET_REMOTE = "transfer_remote"
 TRANSFER_CONFIG = "transfer.yaml"
@@ -145,6 +149,10 @@ class GitRepo(TestServer):
         self.run_cmd("git init .")
         self.run_cmd("git checkout main")
 
+    def commit(self, msg):
+        "Add all files and commit in one shell invocation"
+        self.run_cmd('git add . && git commit -m "%s"' % msg)
+
 class P4Server(TestServer):
     def __init__(self, root, logger):
         self.root = root
@@ -208,12 +216,9 @@ class P4Server(TestServer):
 class TestGitP4Transfer(unittest.TestCase):
 
     def __init__(self, methodName='runTest'):
-        global saved_stdoutput, test_logger
-        saved_stdoutput.truncate(0)
+        global test_logger
         if test_logger is None:
             test_logger = logutils.getLogger(GitP4Transfer.LOGGER_NAME, stream=saved_stdoutput)
-        else:
-            logutils.resetLogger(GitP4Transfer.LOGGER_NAME)
         self.logger = test_logger
         super(TestGitP4Transfer, self).__init__(methodName=methodName)
 
@@ -229,11 +234,15 @@ class TestGitP4Transfer(unittest.TestCase):
         self.assertEqual(expected, content)
 
     def setUp(self):
+        # Test instances are all constructed before any run, so clear captured output per test here
+        saved_stdoutput.seek(0)
+        saved_stdoutput.truncate()
         self.setDirectories()
 
     def tearDown(self):
         self.target.shutDown()
-        time.sleep(0.1)
+        if os.name == "nt":     # Give the rsh p4d time to release db files before the next cleanup
+            time.sleep(0.1)
         # self.cleanupTestTree()
 
     def setDirectories(self):
@@ -281,7 +290,7 @@ class TestGitP4Transfer(unittest.TestCase):
 
     def setupTransfer(self):
         """Creates a config file with default mappings"""
-        msg = "Test: %s ======================" % inspect.stack()[1][3]
+        msg = "Test: %s ======================" % inspect.currentframe().f_back.f_code.co_name
         self.logger.debug(msg)
         config = self.getDefaultOptions()
         self.createConfigFile(options=config)
@@ -330,9 +339,7 @@ class TestGitP4Transfer(unittest.TestCase):
         return result
 
     def assertCounters(self, sourceValue, targetValue):
-        commits = run_cmd('git rev-list main').split('\n')
-        commits = [x for x in commits if x]
-        sourceCounter = len(commits)
+        sourceCounter = int(run_cmd('git rev-list --count main').strip())
         targetCounter = len(self.target.p4.run("changes"))
         self.assertEqual(sourceCounter, sourceValue, "Source counter is not {} but {}".format(sourceValue, sourceCounter))
         self.assertEqual(targetCounter, targetValue, "Target counter is not {} but {}".format(targetValue, targetCounter))
@@ -554,13 +561,11 @@ class TestGitP4Transfer(unittest.TestCase):
         file2 = os.path.join(inside, "file2")
         create_file(file1, 'Test content')
 
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "first change"')
+        self.source.commit("first change")
 
         self.source.run_cmd('git checkout -b branch1')
         create_file(file2, 'Test content2')
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "2nd change"')
+        self.source.commit("2nd change")
 
         gitinfo = GitP4Transfer.GitInfo(test_logger)
         branches = ['main', 'branch1']
@@ -580,6 +585,39 @@ class TestGitP4Transfer(unittest.TestCase):
         self.assertEqual('.p4config', fc[0].filenames[0])
         self.assertEqual('file1', fc[1].filenames[0])
 
+    def testCommitDescriptions(self):
+        "Commit messages which could be mistaken for the end of the description or for diff output"
+        self.setupTransfer()
+
+        inside = self.source.repo_root
+        file1 = os.path.join(inside, "file1")
+        file2 = os.path.join(inside, "file2")
+        create_file(file1, 'Test content')
+        self.source.commit("first change")
+
+        create_file(file2, 'Test content2')
+        msgFile = os.path.join(self.transfer_root, 'msg.txt')
+        create_file(msgFile, "Second change\n\nBody after blank line\n__END_OF_DESC__\n\n"
+                    ":100644 100644 abc def M\tfake\n")
+        self.source.run_cmd('git add .')
+        self.source.run_cmd('git commit -F "%s"' % msgFile)
+
+        gitinfo = GitP4Transfer.GitInfo(test_logger)
+        commitList, commits = gitinfo.getCommitDiffs(['main'])
+        gitinfo.close()
+        self.assertEqual(2, len(commitList))
+        self.assertEqual('first change', commits[commitList[0]].description)
+        fc = commits[commitList[0]].fileChanges
+        self.assertEqual(1, len(fc))
+        self.assertEqual('file1', fc[0].filenames[0])
+        # Blank lines are dropped from descriptions, but everything else is kept as is
+        self.assertEqual('Second change\nBody after blank line\n__END_OF_DESC__\n:100644 100644 abc def M\tfake',
+                         commits[commitList[1]].description)
+        fc = commits[commitList[1]].fileChanges
+        self.assertEqual(1, len(fc))
+        self.assertEqual('file2', fc[0].filenames[0])
+        self.assertEqual('A', fc[0].changeTypes)
+
     def testAdd(self):
         "Basic file add"
         self.setupTransfer()
@@ -588,8 +626,7 @@ class TestGitP4Transfer(unittest.TestCase):
         file1 = os.path.join(inside, "file1")
         create_file(file1, 'Test content')
 
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "first change"')
+        self.source.commit("first change")
 
         self.run_GitP4Transfer()
 
@@ -610,8 +647,7 @@ class TestGitP4Transfer(unittest.TestCase):
         file1 = os.path.join(inside, "file1®")
         create_file(file1, 'Test content')
 
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "first change"')
+        self.source.commit("first change")
 
         self.run_GitP4Transfer()
 
@@ -633,11 +669,9 @@ class TestGitP4Transfer(unittest.TestCase):
         file2 = os.path.join(inside, "file2")
         create_file(file1, 'Test content')
 
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "first change"')
+        self.source.commit("first change")
         create_file(file2, 'Test content2')
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "second change"')
+        self.source.commit("second change")
 
         self.run_GitP4Transfer()
 
@@ -660,8 +694,7 @@ class TestGitP4Transfer(unittest.TestCase):
         file2 = os.path.join(inside, "file2")
         create_file(file1, 'Test content')
 
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "first change"')
+        self.source.commit("first change")
 
         self.run_GitP4Transfer()
         self.assertCounters(1, 1)
@@ -675,8 +708,7 @@ class TestGitP4Transfer(unittest.TestCase):
 
         self.source.run_cmd('git checkout main')
         create_file(file2, 'Test content2')
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "second change"')
+        self.source.commit("second change")
 
         self.run_GitP4Transfer()
         self.assertCounters(2, 2)
@@ -700,16 +732,13 @@ class TestGitP4Transfer(unittest.TestCase):
         create_file(file1, 'Test content')
         create_file(file2, 'Test content2')
 
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "first change"')
+        self.source.commit("first change")
 
         append_to_file(file1, "\nMore stuff")
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "edit change"')
+        self.source.commit("edit change")
 
         self.source.run_cmd('git rm file2')
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "delete change"')
+        self.source.commit("delete change")
 
         self.run_GitP4Transfer()
 
@@ -733,6 +762,40 @@ class TestGitP4Transfer(unittest.TestCase):
         result = self.target.p4cmd('print', '//depot/import/file1')
         self.assertEqual(b'Test content\nMore stuff', result[1])
 
+    def testFileBatches(self):
+        "More files in a single commit than are passed to a single p4 command"
+        self.setupTransfer()
+
+        inside = self.source.repo_root
+        numFiles = GitP4Transfer.P4Target.fileBatchSize + 1
+        for i in range(numFiles):
+            create_file(os.path.join(inside, "file%d" % i), 'Test content\n')
+        self.source.commit("first change")
+
+        for i in range(numFiles):
+            append_to_file(os.path.join(inside, "file%d" % i), 'More content\n')
+            create_file(os.path.join(inside, "new%d" % i), 'New content\n')
+        self.source.commit("edit and add change")
+
+        self.source.run_cmd('git rm -q file*')
+        self.source.run_cmd('git commit -m "delete change"')
+
+        self.run_GitP4Transfer()
+        self.assertCounters(3, 3)
+
+        self.assertEqual([], self.target.p4cmd('opened', '-a'))
+        files = self.target.p4cmd('files', '-e', '//depot/...')
+        self.assertEqual(numFiles, len(files))
+        self.assertEqual(2 * numFiles, len(self.target.p4cmd('files', '-a', '//depot/import/file...@2')))
+
+        # Every file must have been included, whichever batch it was in
+        filelogs = self.target.p4cmd('filelog', '//depot/import/file...')
+        self.assertEqual(numFiles, len(filelogs))
+        for filelog in filelogs:
+            self.assertEqual(['delete', 'edit', 'add'], filelog['action'])
+        result = self.target.p4cmd('print', '//depot/import/file%d#2' % (numFiles - 1))
+        self.assertEqual(b'Test content\nMore content\n', result[1])
+
     def testAddSimpleBranch(self):
         "Basic simple branch and merge of a file"
         self.setupTransfer()
@@ -741,13 +804,11 @@ class TestGitP4Transfer(unittest.TestCase):
         file1 = os.path.join(inside, "file1")
         create_file(file1, 'Test content\n')
 
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "first change"')
+        self.source.commit("first change")
 
         self.source.run_cmd('git checkout -b branch1')
         append_to_file(file1, "branch change\n")
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "edit change"')
+        self.source.commit("edit change")
 
         self.source.run_cmd('git checkout main')
         self.source.run_cmd('git merge --no-edit branch1')
@@ -771,6 +832,55 @@ class TestGitP4Transfer(unittest.TestCase):
         result = self.target.p4cmd('print', '//depot/import/file1')
         self.assertEqual(b'Test content\nbranch change\n', result[1])
 
+    @unittest.skipUnless(GitP4Transfer.importPygit2(), "pygit2 not installed")
+    def testPygit2(self):
+        "Transfer with use_pygit2 - diffs read via pygit2 must match those from git diff-tree"
+        config = self.getDefaultOptions()
+        config['use_pygit2'] = 'y'
+        self.createConfigFile(options=config)
+
+        inside = self.source.repo_root
+        file1 = os.path.join(inside, "file1")
+        file2 = os.path.join(inside, "file2")
+        file3 = os.path.join(inside, "file3")
+        create_file(file1, 'Test content\n')
+        create_file(file3, 'Test content3\n')
+        self.source.commit("first change")
+
+        self.source.run_cmd('git checkout -b branch1')
+        append_to_file(file1, "branch change\n")
+        os.remove(file3)
+        os.symlink("file1", file3)     # Type change to be seen in the merge
+        self.source.commit("edit change")
+
+        self.source.run_cmd('git checkout main')
+        create_file(file2, 'Test content2\n')
+        self.source.commit("new file on main")
+        self.source.run_cmd('git merge --no-edit branch1')
+
+        gitinfo = GitP4Transfer.GitInfo(test_logger)
+        pygit2info = GitP4Transfer.GitInfo(test_logger, usePygit2=True)
+        commitList, commits = gitinfo.getCommitDiffs(['main'])
+        self.assertEqual(3, len(commitList))
+        self.assertEqual(2, len(commits[commitList[2]].parents))
+        for commitID in commitList[1:]:
+            # Similarity scores are calculated differently by libgit2 so are not compared
+            expected = sorted(e._replace(status_score=None) for e in gitinfo.getDiffEntries(commits[commitID]))
+            actual = sorted(e._replace(status_score=None) for e in pygit2info.getDiffEntries(commits[commitID]))
+            self.assertEqual(expected, actual)
+        gitinfo.close()
+        pygit2info.close()
+
+        self.run_GitP4Transfer()
+        self.assertCounters(3, 3)
+
+        result = self.target.p4cmd('print', '//depot/import/file1')
+        self.assertEqual(b'Test content\nbranch change\n', result[1])
+        result = self.target.p4cmd('print', '//depot/import/file2')
+        self.assertEqual(b'Test content2\n', result[1])
+        fstat = self.target.p4cmd('fstat', '//depot/import/file3')
+        self.assertEqual('symlink', fstat[0]['headType'])
+
     # def testSimpleMerge(self):
     #     "Basic simple branch and merge - only taking main changes"
     #     self.setupTransfer()
@@ -838,8 +948,7 @@ class TestGitP4Transfer(unittest.TestCase):
         file2 = os.path.join(inside, "file2")
         create_file(file1, 'Test content\n')
 
-        self.source.run_cmd('git add .')
-        self.source.run_cmd('git commit -m "1: first change"')
+        self.source.commit("1: first change")
 
         self.source.run_cmd('git mv %s %s' % (file1, file2))
         self.source.run_cmd('git commit -m "2: rename"')
@@ -1001,6 +1110,28 @@ class TestGitP4Transfer(unittest.TestCase):
     #     self.assertCounters(1, 1)
 
 
+class TestEvalIntExpression(unittest.TestCase):
+    "Config value arithmetic - doesn't need a server"
+
+    def testAccepted(self):
+        self.assertEqual(60, GitP4Transfer.evalIntExpression("60"))
+        self.assertEqual(10080, GitP4Transfer.evalIntExpression("7 * 24 * 60"))
+        self.assertEqual(20 * 1024 * 1024, GitP4Transfer.evalIntExpression(" 20 * 1024 * 1024 "))
+        self.assertEqual(1024, GitP4Transfer.evalIntExpression("2**10"))
+        self.assertEqual(20 * 2**20, GitP4Transfer.evalIntExpression("20 * 2**20"))
+        self.assertEqual(3, GitP4Transfer.evalIntExpression("10/3"))
+        self.assertEqual(3, GitP4Transfer.evalIntExpression("10//3"))
+        self.assertEqual(1, GitP4Transfer.evalIntExpression("10 % 3"))
+        self.assertEqual(1000, GitP4Transfer.evalIntExpression("1e3"))
+        self.assertEqual(-5, GitP4Transfer.evalIntExpression("-(2 + 3)"))
+
+    def testRejected(self):
+        for expr in ["", "abc", "__import__('os').getcwd()", "len('abc')", "[1, 2]", "'60'",
+                     "1 if True else 2", "1 << 4", "2**1000", "1/0", "1e999", "60 +"]:
+            with self.assertRaises(ValueError, msg=expr):
+                GitP4Transfer.evalIntExpression(expr)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--p4d', default=P4D)